@@ -26,6 +26,8 @@
 
 import math
 import warnings
+from contextlib import nullcontext
+
 import torch
 import torch.nn as nn
 from mmcv.cnn import xavier_init, constant_init
@@ -42,6 +44,117 @@ from mmcv.ops.multi_scale_deform_attn import multi_scale_deformable_attn_pytorch
 from .multi_scale_deformable_attn_function import MultiScaleDeformableAttnFunction_fp32
 
 
+def _offsets_and_weights(offset_feats, query, offsets_weight, offsets_bias, weights_weight, weights_bias,
+                         num_heads, num_levels, num_points):
+    """Project the queries into sampling offsets and attention weights.
+
+    The 1*1 convs run as one batched GEMM over the valid bev queue slots,
+    which writes its output directly in the layout of the deformable
+    attention, so neither a permute nor a contiguous copy is needed.
+
+    Args:
+        offset_feats (Tensor): Output of the depthwise conv with shape
+            (bs, num_query, embed_dims * num_bev_queue).
+        query (Tensor): The query with shape
+            (bs, num_query, embed_dims * num_bev_queue).
+        offsets_weight (Tensor): Pointwise weight of the valid queue slots
+            with shape (num_valid, num_heads * num_levels * num_points * 2,
+            embed_dims * num_bev_queue).
+        offsets_bias (Tensor): Pointwise bias of the valid queue slots
+            with shape (num_valid, 1, num_heads * num_levels * num_points * 2).
+        weights_weight (Tensor): Same as `offsets_weight` for the
+            attention weights.
+        weights_bias (Tensor): Same as `offsets_bias` for the
+            attention weights.
+        num_heads (int): Parallel attention heads.
+        num_levels (int): The number of feature map used in Attention.
+        num_points (int): The number of sampling points for each query
+            in each head.
+
+    Returns:
+        tuple[Tensor]: The sampling offsets with shape
+            (num_valid * bs, num_query, num_heads, num_levels, num_points, 2)
+            and the unnormalized attention weights with shape
+            (num_valid * bs, num_query, num_heads, num_levels, num_points),
+            the softmax is taken by the caller.
+    """
+    num_valid = offsets_weight.size(0)
+    bs, num_query, _dims = query.shape
+    # the same rows are shared by all the slots, expand keeps it a stride-0 view
+    sampling_offsets = torch.baddbmm(
+        offsets_bias, offset_feats.reshape(1, bs * num_query, _dims).expand(num_valid, -1, -1),
+        offsets_weight.transpose(1, 2))
+    attention_weights = torch.baddbmm(
+        weights_bias, query.reshape(1, bs * num_query, _dims).expand(num_valid, -1, -1),
+        weights_weight.transpose(1, 2))
+
+    sampling_offsets = sampling_offsets.view(
+        num_valid * bs, num_query, num_heads, num_levels, num_points, 2)
+    attention_weights = attention_weights.view(
+        num_valid * bs, num_query, num_heads, num_levels, num_points)
+    return sampling_offsets, attention_weights
+
+
+def _locations_and_weights(reference_points, sampling_offsets, offset_scale, attention_logits):
+    """Turn the projected offsets and logits into the inputs of the
+    deformable attention.
+
+    Args:
+        reference_points (Tensor): The normalized reference points with
+            shape (bs, num_query, num_levels, 2), or
+            (bs, num_query, num_levels, 4) for reference boxes.
+        sampling_offsets (Tensor): The sampling offsets with shape
+            (bs, num_query, num_heads, num_levels, num_points, 2).
+        offset_scale (Tensor): The scale applied to `sampling_offsets`,
+            broadcastable to its shape, e.g. the reciprocal (w, h) of each
+            level with shape (1, 1, 1, num_levels, 1, 2).
+        attention_logits (Tensor): The unnormalized attention weights with
+            shape (bs, num_query, num_heads, num_levels, num_points).
+
+    Returns:
+        tuple[Tensor]: The normalized sampling locations, with the same
+            shape as `sampling_offsets`, and the attention weights after
+            the softmax over all the levels and points of each head.
+    """
+    sampling_locations = reference_points[:, :, None, :, None, :2] + sampling_offsets * offset_scale
+    attention_weights = attention_logits.flatten(-2).softmax(-1).view_as(attention_logits)
+    return sampling_locations, attention_weights
+
+
+# fuse the location arithmetic and the softmax with inductor when it is available,
+# the deformable attention function stays outside the compiled region. only used
+# on CUDA, the pytorch fallback keeps the eager version. the default mode is used on
+# purpose, every encoder layer keeps its outputs alive for backward, which the cuda
+# graph replays of reduce-overhead would overwrite
+_fused_locations_and_weights = _locations_and_weights
+if hasattr(torch, 'compile'):
+    _fused_locations_and_weights = torch.compile(_locations_and_weights, dynamic=True)
+
+
+def _int8_queue_linear(x, weight, weight_scale, bias):
+    """Int8 counterpart of the per queue slot GEMM in `_offsets_and_weights`.
+
+    The activation is quantized once per row and shared by all the slots,
+    the int32 accumulators are dequantized back to fp32.
+
+    Args:
+        x (Tensor): Input rows shared by all the slots with shape (M, K).
+        weight (Tensor): Int8 weight of the valid queue slots with shape
+            (num_valid, N, K).
+        weight_scale (Tensor): Per output channel scale of `weight` with
+            shape (num_valid, 1, N).
+        bias (Tensor): Float bias with shape (num_valid, 1, N).
+
+    Returns:
+        Tensor: The output with shape (num_valid, M, N).
+    """
+    x = x.float()
+    x_scale = x.abs().amax(-1, keepdim=True).clamp(min=1e-8) / 127.
+    x_int8 = (x / x_scale).round_().clamp_(-127, 127).to(torch.int8)
+    out = torch.stack([torch._int_mm(x_int8, w.t()) for w in weight])
+    return out.float() * (x_scale * weight_scale) + bias
+
+
 @ATTENTION.register_module()
 class TemporalSelfAttentionV2(BaseModule):
     """An attention module used in Deformable-Detr.
@@ -50,7 +163,8 @@ class TemporalSelfAttentionV2(BaseModule):
     <https://arxiv.org/pdf/2010.04159.pdf>`_.
 
     Based on TemporalSelfAttention:
-        Change sampling_offsets from Linear to 3*3 or bigger conv.
+        Change sampling_offsets from Linear to 3*3 or bigger conv,
+        factored into a depthwise 3*3 conv and a pointwise 1*1 conv.
 
     Args:
         embed_dims (int): The embedding dimension of Attention.
@@ -67,12 +181,20 @@ class TemporalSelfAttentionV2(BaseModule):
         batch_first (bool): Key, Query and Value are shape of
             (batch, n, embed_dim)
             or (n, batch, embed_dim). Default to False.
+        use_bf16 (bool): Run the projections and the convs under bf16
+            autocast on CUDA, the deformable attention itself always
+            runs in fp32. Default: False.
+            For inference, the pointwise convs can further run in int8,
+            see `quantize_int8`.
         norm_cfg (dict): Config dict for normalization layer.
             Default: None.
         init_cfg (obj:`mmcv.ConfigDict`): The Config for initialization.
             Default: None.
     """
 
+    # the 1*1 convs with int8 copies of their weights, see quantize_int8
+    _int8_convs = ('sampling_offsets_pw', 'attention_weights')
+
     def __init__(self,
                  embed_dims=256,
                  num_heads=8,
@@ -82,6 +204,7 @@ class TemporalSelfAttentionV2(BaseModule):
                  im2col_step=64,
                  dropout=0.1,
                  batch_first=False,
+                 use_bf16=False,
                  norm_cfg=None,
                  init_cfg=None):
         super().__init__(init_cfg)
@@ -93,6 +216,7 @@ class TemporalSelfAttentionV2(BaseModule):
         self.dropout = nn.Dropout(dropout)
         self.batch_first = batch_first
         self.fp16_enabled = False
+        self.use_bf16 = use_bf16
 
         # you'd better set dim_per_head to a power of 2
         # which is more efficient in the CUDA implementation
@@ -116,37 +240,232 @@ class TemporalSelfAttentionV2(BaseModule):
         self.num_heads = num_heads
         self.num_points = num_points
         self.num_bev_queue = num_bev_queue
-
-        self.sampling_offsets = nn.Conv2d(
-            embed_dims * self.num_bev_queue, num_bev_queue * num_heads * num_levels * num_points * 2, kernel_size=3,
-            stride=1, padding=1)
-        self.attention_weights = nn.Linear(embed_dims * self.num_bev_queue,
-                                           num_bev_queue * num_heads * num_levels * num_points)
+        # reciprocal (w, h) of each level, keyed by the spatial shapes, dtype and device
+        self._norm_cache = {}
+        # static buffer of the concatenated query, only used while capturing a graph
+        self._query_buf = None
+        # set by quantize_int8
+        self.int8_enabled = False
+        # set by capture, the spatial shapes are fixed while recording the graph
+        self._capturing = False
+        self._static_spatial_hw = None
+        self._graph = None
+        self._graph_inputs = None
+        self._graph_output = None
+        self._graph_spatial_hw = None
+
+        # depthwise 3*3 keeps the receptive field, the pointwise 1*1 does the channel projection
+        self.sampling_offsets_dw = nn.Conv2d(
+            embed_dims * self.num_bev_queue, embed_dims * self.num_bev_queue, kernel_size=3,
+            stride=1, padding=1, groups=embed_dims * self.num_bev_queue)
+        # kept as Conv2d for the checkpoint layout, but never called: forward only reads
+        # their weight and bias for the per queue slot baddbmm in _offsets_and_weights,
+        # so forward hooks (e.g. the flops counter of get_flops.py) do not see them
+        self.sampling_offsets_pw = nn.Conv2d(
+            embed_dims * self.num_bev_queue, num_bev_queue * num_heads * num_levels * num_points * 2, kernel_size=1)
+        self.attention_weights = nn.Conv2d(
+            embed_dims * self.num_bev_queue, num_bev_queue * num_heads * num_levels * num_points, kernel_size=1)
+        # same for value_proj, forward runs it as a baddbmm over the queue slots
         self.value_proj = nn.Linear(embed_dims, embed_dims)
         self.output_proj = nn.Linear(embed_dims, embed_dims)
         self.init_weights()
 
     def init_weights(self):
         """Default initialization for Parameters of Module."""
-        constant_init(self.sampling_offsets, 0.)
+        # keep the default init of the depthwise conv, otherwise
+        # neither of the two convs would ever receive a gradient
+        constant_init(self.sampling_offsets_pw, 0.)
         thetas = torch.arange(
             self.num_heads,
             dtype=torch.float32) * (2.0 * math.pi / self.num_heads)
         grid_init = torch.stack([thetas.cos(), thetas.sin()], -1)
+        # the output channels of sampling_offsets_pw are ordered as
+        # (num_bev_queue, num_heads, num_levels, num_points, 2), which is the
+        # layout _offsets_and_weights views them in, grid_init must follow it
         grid_init = (grid_init /
                      grid_init.abs().max(-1, keepdim=True)[0]).view(
-            self.num_heads, 1, 1,
-            2).repeat(1, self.num_levels * self.num_bev_queue, self.num_points, 1)
-
-        for i in range(self.num_points):
-            grid_init[:, :, i, :] *= i + 1
-
-        self.sampling_offsets.bias.data = grid_init.view(-1)
+            1, self.num_heads, 1, 1,
+            2).repeat(self.num_bev_queue, 1, self.num_levels, self.num_points, 1)
+        # the i-th point starts i + 1 steps away along its head direction
+        grid_init.mul_(torch.arange(
+            1, self.num_points + 1, dtype=grid_init.dtype).view(1, 1, 1, -1, 1))
+
+        assert grid_init.numel() == self.sampling_offsets_pw.bias.numel()
+        self.sampling_offsets_pw.bias.data = grid_init.view(-1)
         constant_init(self.attention_weights, val=0., bias=0.)
         xavier_init(self.value_proj, distribution='uniform', bias=0.)
         xavier_init(self.output_proj, distribution='uniform', bias=0.)
         self._is_init = True
 
+    @torch.no_grad()
+    def quantize_int8(self):
+        """Quantize the weights of `sampling_offsets_pw` and `attention_weights`
+        to int8 for inference.
+
+        Weights use a symmetric scale per output channel, activations are
+        quantized per row at runtime. The float weights are kept, the int8
+        path is only taken in eval mode on CUDA and where `torch._int_mm`
+        can handle the shapes, otherwise the float convs are used.
+        A later `load_state_dict` quantizes the loaded weights again, any
+        other change of the float weights (e.g. more training) leaves the
+        int8 path stale until `quantize_int8` is called again.
+        """
+        for name in self._int8_convs:
+            self._quantize_conv_weight(name, getattr(self, name).weight)
+        self.int8_enabled = True
+        return self
+
+    def _quantize_conv_weight(self, name, weight):
+        conv = getattr(self, name)
+        weight = weight.to(conv.weight.device).view(self.num_bev_queue, -1, conv.in_channels).float()
+        scale = weight.abs().amax(-1, keepdim=True).clamp(min=1e-8) / 127.
+        weight_int8 = (weight / scale).round_().clamp_(-127, 127).to(torch.int8)
+        # derived from the float weights, so kept out of the state dict
+        self.register_buffer(f'{name}_int8', weight_int8, persistent=False)
+        self.register_buffer(f'{name}_scale', scale.transpose(1, 2).contiguous(), persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        if not self.int8_enabled:
+            return
+        # the convs are loaded after this module, so quantize the incoming weights,
+        # mismatching ones are left to the convs to report
+        with torch.no_grad():
+            for name in self._int8_convs:
+                weight = state_dict.get(f'{prefix}{name}.weight')
+                if weight is not None and weight.shape == getattr(self, name).weight.shape:
+                    self._quantize_conv_weight(name, weight)
+
+    def _use_int8(self, query):
+        # torch._int_mm needs more than 16 rows and K, N multiples of 8
+        return (self.int8_enabled and not self.training and query.is_cuda
+                and hasattr(torch, '_int_mm')
+                and query.size(0) * query.size(1) > 16
+                and query.size(-1) % 8 == 0
+                and self.sampling_offsets_pw_int8.size(1) % 8 == 0
+                and self.attention_weights_int8.size(1) % 8 == 0)
+
+    def _int8_offsets_and_weights(self, offset_feats, query, valid_queue_start):
+        """Same as `_offsets_and_weights` with the int8 weights."""
+        bs, num_query, _dims = query.shape
+        start = valid_queue_start
+        sampling_offsets = _int8_queue_linear(
+            offset_feats.reshape(-1, _dims), self.sampling_offsets_pw_int8[start:],
+            self.sampling_offsets_pw_scale[start:], self._queue_params(self.sampling_offsets_pw, start)[1])
+        attention_weights = _int8_queue_linear(
+            query.reshape(-1, _dims), self.attention_weights_int8[start:],
+            self.attention_weights_scale[start:], self._queue_params(self.attention_weights, start)[1])
+        num_valid = sampling_offsets.size(0)
+        sampling_offsets = sampling_offsets.view(
+            num_valid * bs, num_query, self.num_heads, self.num_levels, self.num_points, 2)
+        attention_weights = attention_weights.view(
+            num_valid * bs, num_query, self.num_heads, self.num_levels, self.num_points)
+        return sampling_offsets, attention_weights
+
+    @torch.no_grad()
+    def capture(self, num_warmup=3, **inputs):
+        """Record the forward into a CUDA graph for inference with fixed shapes.
+
+        The tensors in `inputs` (the keyword arguments of `forward`) are
+        cloned into static buffers. A few warmup forwards on a side stream
+        fill the offset normalizer cache and the query buffer and compile
+        `_fused_locations_and_weights` before recording. Use `replay` afterwards.
+
+        Returns:
+            Tensor: The static output, overwritten by every `replay`.
+        """
+        assert not self.training, 'capture is only supported in eval mode'
+        static_inputs = {k: v.clone() if torch.is_tensor(v) else v for k, v in inputs.items()}
+        self._capturing = True
+        self._query_buf = None
+        try:
+            stream = torch.cuda.Stream()
+            stream.wait_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(stream):
+                for _ in range(num_warmup):
+                    self(**static_inputs)
+            torch.cuda.current_stream().wait_stream(stream)
+
+            graph = torch.cuda.CUDAGraph()
+            # no host sync is allowed while recording, take the shapes once beforehand
+            spatial_hw = tuple(tuple(hw) for hw in static_inputs['spatial_shapes'].tolist())
+            self._static_spatial_hw = spatial_hw
+            with torch.cuda.graph(graph):
+                static_output = self(**static_inputs)
+        finally:
+            self._capturing = False
+            self._static_spatial_hw = None
+        self._graph = graph
+        self._graph_spatial_hw = spatial_hw
+        self._graph_inputs = static_inputs
+        self._graph_output = static_output
+        return static_output
+
+    def replay(self, **inputs):
+        """Copy `inputs` into the static buffers and replay the captured graph.
+
+        Only the tensors given to `capture` can be passed, with the same
+        shapes. Non-tensor arguments are baked into the graph and skipped.
+        The spatial shapes are baked in as well, passing them only checks
+        they are the captured ones (at the cost of a host sync).
+        """
+        assert self._graph is not None, 'call capture first'
+        for k, v in inputs.items():
+            assert k in self._graph_inputs, f'{k} was not given to capture'
+            if not torch.is_tensor(v):
+                continue
+            if k == 'spatial_shapes':
+                assert tuple(tuple(hw) for hw in v.tolist()) == self._graph_spatial_hw, \
+                    'spatial_shapes differ from the captured ones'
+                continue
+            static = self._graph_inputs[k]
+            assert torch.is_tensor(static) and static.shape == v.shape, \
+                f'{k} must have the captured shape {tuple(static.shape)}'
+            static.copy_(v)
+        self._graph.replay()
+        return self._graph_output
+
+    def _queue_params(self, conv, valid_queue_start):
+        """Weight and bias of a 1*1 conv whose output channels are grouped
+        by bev queue slot, split per slot from `valid_queue_start` on."""
+        weight = conv.weight.view(self.num_bev_queue, -1, conv.in_channels)[valid_queue_start:]
+        bias = conv.bias.view(self.num_bev_queue, 1, -1)[valid_queue_start:]
+        return weight, bias
+
+    def _cat_query(self, prev, query, query_pos):
+        """torch.cat([prev, query + query_pos], -1).
+
+        Without grad the sum is added straight into the output. While
+        capturing a graph the output is a buffer kept on the module (every
+        slot of it is overwritten, so it is never zeroed), otherwise it is
+        allocated per call so no layer pins it for its lifetime.
+        """
+        if torch.is_grad_enabled():
+            if query_pos is not None:
+                query = query + query_pos
+            return torch.cat([prev, query], -1)
+        prev_dims = prev.size(-1)
+        shape = (*query.shape[:-1], prev_dims + query.size(-1))
+        buf = self._query_buf if self._capturing else None
+        # a buffer allocated under inference_mode can't be written outside of it
+        if (buf is None or buf.shape != shape or buf.dtype != query.dtype or buf.device != query.device
+                or (buf.is_inference() and not torch.is_inference_mode_enabled())):
+            buf = query.new_empty(shape)
+            if self._capturing:
+                self._query_buf = buf
+        buf[..., :prev_dims] = prev
+        if query_pos is None:
+            buf[..., prev_dims:] = query
+        else:
+            torch.add(query, query_pos, out=buf[..., prev_dims:])
+        return buf
+
+    def _autocast(self, x):
+        """bf16 autocast for the GEMM/conv parts if enabled."""
+        if self.use_bf16 and x.is_cuda:
+            return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+        return nullcontext()
+
     # @run_time('CustomMultiScaleDeformableAttentionV4')
     @deprecated_api_warning({'residual': 'identity'},
                             cls_name='MultiScaleDeformableAttention')
@@ -203,98 +522,110 @@ class TemporalSelfAttentionV2(BaseModule):
 
         if identity is None:
             identity = query
-        if query_pos is not None:
-            query = query + query_pos
         if not self.batch_first:
             # change to (bs, num_query, embed_dims)
             query = query.permute(1, 0, 2)
             value = value.permute(1, 0, 2)
+            if query_pos is not None:
+                query_pos = query_pos.permute(1, 0, 2)
 
         bs, num_query, _ = query.shape
         _bs, num_value, dims = value.shape
-        assert (spatial_shapes[:, 0] * spatial_shapes[:, 1]).sum() == num_value
+        # one host sync for all the shape bookkeeping below, none while capturing a graph
+        if self._static_spatial_hw is not None:
+            spatial_hw = self._static_spatial_hw
+        else:
+            spatial_hw = tuple(tuple(hw) for hw in spatial_shapes.tolist())
+        assert sum(h * w for h, w in spatial_hw) == num_value
 
         lack = self.num_bev_queue - _bs
 
-        # padding query
+        # padding query, query_pos is added while building the concatenated query
         if lack == 0 and _bs > 1:
-            query = torch.cat([value[:-1], query], -1)  # bs, num_query, embed_dims * 2
+            query = self._cat_query(value[:-1], query, query_pos)  # bs, num_query, embed_dims * 2
         elif lack == 1:
-            query = torch.cat([value[0:1].repeat(lack, 1, 1), query], -1)
-
-        # padding value
-        padding_zeros = value.new_zeros([lack, num_value, dims])
-        padding_zeros_ref = reference_points.new_zeros([lack, *reference_points.size()[1:]])
-        value = torch.cat([padding_zeros, value], 0)
-        reference_points = torch.cat([padding_zeros_ref, reference_points], 0)
+            # no previous bev, e.g. self attention on the first frame where value is the raw query:
+            # reuse the current one as is, without a repeated copy
+            query = self._cat_query(value, query, query_pos)
+        elif query_pos is not None:
+            query = query + query_pos
 
-        # value mask
-        mask = value.new_ones([self.num_bev_queue])
-        mask[:lack] = 0
-        value = self.value_proj(value)
+        # value and reference_points are not padded to the full bev queue,
+        # the padding slots are skipped in the offsets and weights instead
+        # project all the queue slots with one batched GEMM. value is usually the permuted
+        # (num_value, _bs, dims) bev queue, flattening it would copy it first, while the batched
+        # GEMM reads it strided and writes (_bs, num_value, num_heads, dim_per_head) directly
+        with self._autocast(value):
+            value = torch.baddbmm(
+                self.value_proj.bias, value, self.value_proj.weight.t().expand(_bs, -1, -1))
+        value = value.view(_bs, num_value, self.num_heads, -1)
 
         if key_padding_mask is not None:
-            value = value.masked_fill(key_padding_mask[..., None], 0.0)
-
-        value = value.reshape(self.num_bev_queue, num_value, self.num_heads, -1)
+            # the projection output is a fresh tensor not saved for backward, zero it in place
+            value.masked_fill_(key_padding_mask[-_bs:, :, None, None], 0.0)
 
-        # (bs, num_query, embed_dims * 2) --> (bs, embed_dims * 2, num_query)
+        # (bs, num_query, embed_dims * 2) --> (bs, embed_dims * 2, bev_h, bev_w) as a channels-last view,
+        # so the depthwise conv output comes back to (bs, num_query, embed_dims * 2) without a copy
         bs, num_query, _dims = query.shape
-        query = query.permute(0, 2, 1).view(bs, _dims, spatial_shapes[0, 0], spatial_shapes[0, 1])
-        sampling_offsets = self.sampling_offsets(query)
-        sampling_offsets = sampling_offsets.permute(0, 2, 3, 1)
-        sampling_offsets = sampling_offsets.view(
-            bs, num_query, self.num_heads, self.num_bev_queue, self.num_levels, self.num_points, 2)
-
-        query = query.permute(0, 2, 3, 1).view(bs, num_query, _dims)
-        attention_weights = self.attention_weights(query).view(
-            bs, num_query, self.num_heads, self.num_bev_queue, self.num_levels * self.num_points)
-        attention_weights = attention_weights.softmax(-1)
-
-        attention_weights = attention_weights.view(bs, num_query,
-                                                   self.num_heads,
-                                                   self.num_bev_queue,
-                                                   self.num_levels,
-                                                   self.num_points)
-
-        attention_weights = attention_weights.permute(3, 0, 1, 2, 4, 5) \
-            .view(bs * self.num_bev_queue, num_query, self.num_heads, self.num_levels, self.num_points).contiguous()
-        sampling_offsets = sampling_offsets.permute(3, 0, 1, 2, 4, 5, 6) \
-            .view(bs * self.num_bev_queue, num_query, self.num_heads, self.num_levels, self.num_points, 2).contiguous()
+        with self._autocast(query):
+            offset_feats = self.sampling_offsets_dw(query.permute(0, 2, 1).view(bs, _dims, *spatial_hw[0]))
+            offset_feats = offset_feats.permute(0, 2, 3, 1).reshape(bs, num_query, _dims)
+            # the padding slots of the bev queue are never computed
+            if self._use_int8(query):
+                sampling_offsets, attention_weights = self._int8_offsets_and_weights(
+                    offset_feats, query, lack)
+            else:
+                sampling_offsets, attention_weights = _offsets_and_weights(
+                    offset_feats, query,
+                    *self._queue_params(self.sampling_offsets_pw, lack),
+                    *self._queue_params(self.attention_weights, lack),
+                    self.num_heads, self.num_levels, self.num_points)
+
+        if self.use_bf16:
+            # the deformable attention kernel only takes float/half and custom_fwd
+            # does not cast outside autocast, so go back to fp32 explicitly,
+            # before the softmax and the location arithmetic
+            value = value.float()
+            sampling_offsets = sampling_offsets.float()
+            attention_weights = attention_weights.float()
 
         if reference_points.shape[-1] == 2:
-            offset_normalizer = torch.stack(
-                [spatial_shapes[..., 1], spatial_shapes[..., 0]], -1)
-            sampling_locations = reference_points[:, :, None, :, None, :] \
-                                 + sampling_offsets \
-                                 / offset_normalizer[None, None, None, :, None, :]
+            # in the precision of the offsets, like the division it replaces
+            key = (spatial_hw, sampling_offsets.dtype, sampling_offsets.device)
+            offset_scale = self._norm_cache.get(key)
+            if offset_scale is None:
+                offset_normalizer = torch.tensor(
+                    [[w, h] for h, w in spatial_hw], dtype=sampling_offsets.dtype, device=sampling_offsets.device)
+                offset_scale = offset_normalizer.reciprocal()[None, None, None, :, None, :]
+                self._norm_cache[key] = offset_scale
         elif reference_points.shape[-1] == 4:
-            sampling_locations = reference_points[:, :, None, :, None, :2] \
-                                 + sampling_offsets / self.num_points \
-                                 * reference_points[:, :, None, :, None, 2:] \
-                                 * 0.5
+            offset_scale = reference_points[:, :, None, :, None, 2:] * (0.5 / self.num_points)
         else:
             raise ValueError(
                 f'Last dim of reference_points must be'
                 f' 2 or 4, but get {reference_points.shape[-1]} instead.')
-        if torch.cuda.is_available() and value.is_cuda:
 
+        if torch.cuda.is_available() and value.is_cuda:
+            sampling_locations, attention_weights = _fused_locations_and_weights(
+                reference_points, sampling_offsets, offset_scale, attention_weights)
             # using fp16 deformable attention is unstable because it performs many sum operations
-            if value.dtype == torch.float16:
-                MultiScaleDeformableAttnFunction = MultiScaleDeformableAttnFunction_fp32
-            else:
-                MultiScaleDeformableAttnFunction = MultiScaleDeformableAttnFunction_fp32
-            output = MultiScaleDeformableAttnFunction.apply(
+            output = MultiScaleDeformableAttnFunction_fp32.apply(
                 value, spatial_shapes, level_start_index, sampling_locations,
                 attention_weights, self.im2col_step)
         else:
+            sampling_locations, attention_weights = _locations_and_weights(
+                reference_points, sampling_offsets, offset_scale, attention_weights)
             output = multi_scale_deformable_attn_pytorch(
                 value, spatial_shapes, sampling_locations, attention_weights)
-        output = (output.permute(1, 2, 0) * mask[None, None, :])
-        output = output.sum(-1, keepdim=True) / mask.sum()
-        output = output.permute(2, 0, 1)
-
-        output = self.output_proj(output)
+        if _bs > 1:
+            # average over the valid slots of the bev queue
+            output = output.mean(0, keepdim=True)
+
+        with self._autocast(output):
+            output = self.output_proj(output)
+        if self.use_bf16:
+            # back to the precision of the identity for the residual add
+            output = output.to(identity.dtype)
 
         if not self.batch_first:
             # (num_query, bs ,embed_dims)
@@ -37,6 +37,10 @@ def main():
     # set cudnn_benchmark
     if cfg.get('cudnn_benchmark', False):
         torch.backends.cudnn.benchmark = True
+    # set allow_tf32, run fp32 matmuls and convs on TF32 tensor cores
+    if cfg.get('allow_tf32', False):
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
     cfg.model.pretrained = None
     cfg.data.test.test_mode = True
 
@@ -123,6 +123,10 @@ def main():
     # set cudnn_benchmark
     if cfg.get('cudnn_benchmark', False):
         torch.backends.cudnn.benchmark = True
+    # set allow_tf32, run fp32 matmuls and convs on TF32 tensor cores
+    if cfg.get('allow_tf32', False):
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
     # work_dir is determined in this priority: CLI > segment in file > filename
     if args.work_dir is not None: